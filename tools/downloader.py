@@ -4,22 +4,35 @@
 """This script will download the latest n_maps of the map data from BeatSaver API.
 
 # TODO: This script could be improved by using the BeatSaver API's web socket endpoint.
-# TODO: Parallelizing the request and download process can improve the performance.
 # TODO: Can make use of a cache to avoid sending requests to endpoints that the registry might already cover.
-# TODO: Can make use of a cache records to avoid scanning the output directory for maps.
 # TODO: Another improvement can be to add a progress bar to the download process.
-# TODO: Use some heuristic to determine the most probable before time parameter, so it doesn't need to make a trace back all dates from the present to the past.
 # TODO: Option to squelch the logger.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict
+from urllib.parse import urlsplit, urlencode
 from datetime import datetime
 import argparse
 import os, sys
+import shutil
 import logging 
 
+try:
+    import orjson
+    _dumps, _loads = orjson.dumps, orjson.loads
+except ImportError:
+    # fall back to the standard library when orjson is not installed
+    def _dumps(obj): return json.dumps(obj).encode()
+    _loads = json.loads
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("BSDownloader")
+
 # the time the script started
 NOW = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
@@ -36,158 +49,433 @@ class BSDownloader():
     :type output_dir: str
     """
 
-    # the name of the meta file
-    _META_FILE = 'meta.json'
+    # the name of the append-only log holding the meta data of every map, one JSON record per line
+    _META_LOG = 'meta.ndjson'
+    # the name of the per-map meta file written by earlier versions, migrated into the meta log
+    _LEGACY_META_FILE = 'meta.json'
+    # the name of the registry manifest caching the existing maps of the output directory
+    _REGISTRY_FILE = '.registry.json'
     # the request delay
     DELAY = 0
+    # the number of level files downloaded concurrently, kept low to stay polite to the BeatSaver CDN
+    MAX_WORKERS = 8
+    # the number of pages downloaded between flushes of the registry manifest
+    REGISTRY_FLUSH_PAGES = 10
+    # the number of most recently requested pages whose ETag and body are kept for conditional requests
+    ETAG_CACHE_SIZE = 16
 
     def __init__(self, before, n_maps, output_dir):
         """ Constructor method
         """
-        logging.basicConfig(level=logging.INFO)
-        self.logger = logging.getLogger(__class__.__name__)
+        self.logger = logger
         self.n_maps = n_maps
         self.before = before
         # the original before timestamp
         self.org_before = before
         self.output_dir = output_dir
-        self.maps = {**self._get_existing_maps()}
-
-    def download_latest(self, params={'before': '2019-07-21T00:34:41.775Z', 'auto_mapper': False, 'sort': 'LAST_PUBLISHED'}):
+        # a shared session so the connection pool is reused across every request
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=3))
+        # maps a request URL to the ETag and JSON body of its last response, used for conditional requests
+        self._etag_cache = {}
+        self._registry_path = os.path.join(output_dir, self._REGISTRY_FILE)
+        # the sorted, disjoint [bottom, top] lastPublishedAt ranges in which every map has been downloaded,
+        # each paged through without gaps
+        self._covered = []
+        self._meta_log_path = os.path.join(output_dir, self._META_LOG)
+        self.maps = {**self._load_registry()}
+        self._meta_log = open(self._meta_log_path, 'ab+')
+        # terminate a record cut short by an interrupted run so new records start on their own line
+        if self._meta_log.tell() > 0:
+            self._meta_log.seek(-1, os.SEEK_END)
+            if self._meta_log.read(1) != b"\n":
+                self._meta_log.write(b"\n")
+
+    def download_latest(self, params=None):
         """
         Downloads the latest maps from the BeatSaver API.
 
-        :param params: parameters to pass to the API
+        :param params: parameters to pass to the API, by default the maps before the downloader's before timestamp
         :type params: dict
         :return: number of downloaded maps from this run
         :rtype: int
         """
+        if params is None:
+            params = {'before': self.before, 'auto_mapper': False, 'sort': 'LAST_PUBLISHED'}
+
         count = 0
         # flag used to determine if the downloader should continue to download maps
         done_flag = False
         LATEST_ENDPOINT = "https://api.beatsaver.com/maps/latest"
-        self.logger.log(logging.INFO, "Downloading latest maps...")
-
-        while done_flag == False:
-            response = self._requestJSON(LATEST_ENDPOINT, params)
-
-            # if the response is empty, the downloader has finished downloading all the maps
-            if(len(response['docs']) <= 0): 
-                done_flag = True; 
-                break;
-
-            for map_JSON in response['docs']:
-                if map_JSON['id'] not in self.maps:
-                    self.maps[map_JSON['id']] = self._write_meta_file(map_JSON)
-                    self._downloadMap(map_JSON)
-                    # if the map is not in the registry, update the before parameter
-                    
-                    # if the number of maps downloaded is equal to the number of maps to download, the downloader has finished downloading all the maps
-                    if count > self.n_maps:
+        self.logger.info("Downloading latest maps...")
+
+        pages = 0
+        # the range currently paged through without gaps, the cursor only moves past fully downloaded pages.
+        # The top is taken from the server's newest map rather than the client's clock
+        run_top = cursor = None
+        try:
+            # the download work is I/O bound, so a small thread pool is shared across all the pages
+            with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+                while done_flag == False:
+                    response = self._requestJSON(LATEST_ENDPOINT, params)
+
+                    # if the response is empty, the downloader has finished downloading all the maps
+                    if(len(response['docs']) <= 0): 
                         done_flag = True; 
                         break;
 
-                    count += 1
+                    if run_top is None:
+                        run_top = cursor = response['docs'][0]['lastPublishedAt']
+
+                    # skip pages that only hold existing maps without touching the disk
+                    if all(map_JSON['id'] in self.maps for map_JSON in response['docs']):
+                        self.logger.info("All maps of the page are already downloaded")
+                        before = response['docs'][-1]['lastPublishedAt']
+                        # a fully known page inside a covered range marks known history, jump past the range
+                        covering = self._covering_range(before)
+                        if covering:
+                            self.logger.info("Skipping the known history down to %s", covering[0])
+                            before = covering[0]
+
+                        cursor = before
+                        params = {**params, 'before': before}
+                        continue
+
+                    # the new maps grouped by CDN host so consecutive downloads reuse the same pooled keep-alive connections
+                    by_host = defaultdict(list)
+                    # maps are only added to the registry once their level file has been downloaded
+                    level_files = {}
+                    cut_short = False
+                    for map_JSON in response['docs']:
+                        if map_JSON['id'] in self.maps:
+                            self.logger.info("Map %s already downloaded", map_JSON['id'])
+                            continue
+
+                        # only queue as many maps as are needed to reach the number of maps to download
+                        if count + len(level_files) >= self.n_maps:
+                            cut_short = True;
+                            break;
+
+                        # the download URL is parsed once for both the CDN host and the level file name
+                        url = urlsplit(map_JSON['versions'][0]['downloadURL'])
+                        level_files[map_JSON['id']] = self._write_meta_file(map_JSON, url.path.rsplit('/', 1)[-1])
+                        by_host[url.netloc].append(map_JSON)
+
+                    # the meta files are written first, then the level files of the page are downloaded concurrently
+                    futures = {executor.submit(self._downloadMap, map_JSON, level_files[map_JSON['id']]): map_JSON for maps in by_host.values() for map_JSON in maps}
+                    failed = []
+                    for future in as_completed(futures):
+                        map_JSON = futures[future]
+                        # a failed download must not keep the rest of the page from being registered
+                        try:
+                            future.result()
+                        except Exception as e:
+                            self.logger.error("Failed to download map %s: %s", map_JSON['id'], e)
+                            failed.append(map_JSON['id'])
+                            continue
+
+                        self.maps[map_JSON['id']] = level_files[map_JSON['id']]
+                        count += 1
+                        self.logger.info("Finished downloading map %s", map_JSON['id'])
+
+                    # flush the registry every few pages, rewriting it after every page would be quadratic over a backfill
+                    pages += 1
+                    if pages % self.REGISTRY_FLUSH_PAGES == 0:
+                        self._save_registry()
+
+                    # the failed maps are left unregistered, they are retried when the page is paged through on a later run
+                    if failed:
+                        self.logger.error("Failed to download %s maps of the page: %s", len(failed), ", ".join(failed))
+
+                    if cut_short or failed:
+                        # the page leaves a gap, close the current range above it and start a new one from the next page
+                        self._extend_covered(cursor, run_top)
+                        run_top = cursor = None
+                    else:
+                        # every map of the page has been downloaded
+                        cursor = response['docs'][-1]['lastPublishedAt']
 
-                else:
-                    self.logger.log(logging.INFO, "Map {} already downloaded".format(map_JSON['id']))
-            
-            if done_flag == True: break;
+                    # if the number of maps downloaded is equal to the number of maps to download, the downloader has finished downloading all the maps
+                    if count >= self.n_maps:
+                        done_flag = True;
+
+                    # stop before requesting another page
+                    if done_flag == True: break;
 
-            # update the before parameter
-            before = response['docs'][-1]['lastPublishedAt']
+                    # update the before parameter
+                    before = response['docs'][-1]['lastPublishedAt']
 
-            self.logger.log(logging.INFO, "Current maps downloaded: {}/{} maps".format(count, "∞" if self.n_maps == sys.maxsize else self.n_maps))
+                    self.logger.info("Current maps downloaded: %s/%s maps", count, "∞" if self.n_maps == sys.maxsize else self.n_maps)
 
-            self.logger.log(logging.INFO, "Requesting for more maps before {}".format(before))
-            params = {**params, 'before': before}
+                    self.logger.info("Requesting for more maps before %s", before)
+                    params = {**params, 'before': before}
 
-            # wait for a bit before requesting more maps
-            time.sleep(self.DELAY)
+                    # wait for a bit before requesting more maps
+                    time.sleep(self.DELAY)
 
+        finally:
+            # the registry is always flushed once the run ends
+            self._extend_covered(cursor, run_top)
+            self._save_registry()
         
         return count
 
-    def _finish_downloading(self, meta_path):
+    def _finish_downloading(self, meta_JSON):
         """
         If a map directory has been determined not to have finished downloading all its files, it will finish downloading for that map.
-        """
-
-        # iterate through all the maps meta paths
-        meta_JSON = json.load(open(meta_path))
+        A level file is considered finished when its size matches the Content-Length reported by a HEAD request.
 
-        level_path = meta_JSON["versions"][0]["downloadURL"].split('/')[-1]
+        :param meta_JSON: the map's meta data record from the meta log
+        :type meta_JSON: dict
+        """
+        file_name = self._level_file_name(meta_JSON)
+        level_path = os.path.join(self.output_dir, meta_JSON['id'], file_name)
         # if the map has not finished downloading, finish downloading it
-        if not os.path.exists(os.path.join(os.path.dirname(meta_path), level_path)):
-            self.logger.log(logging.INFO, "Map {} is missing its level file".format(meta_JSON['id']))
-            self._downloadMap(meta_JSON)
+        if not os.path.exists(level_path):
+            self.logger.info("Map %s is missing its level file", meta_JSON['id'])
+            self._downloadMap(meta_JSON, file_name)
+            return
+
+        head = self._session.head(meta_JSON["versions"][0]['downloadURL'], allow_redirects=True)
+        head.raise_for_status()
+        expected = int(head.headers.get('Content-Length', -1))
+        # the size can only be verified when the CDN reports it
+        if expected >= 0 and os.path.getsize(level_path) != expected:
+            self.logger.info("Map %s has a truncated level file", meta_JSON['id'])
+            self._downloadMap(meta_JSON, file_name)
                 
 
-    def _downloadMap(self, map_JSON):
+    def _downloadMap(self, map_JSON, file_name=None):
         """
         Performs the actual download of the map.
 
         :param map_JSON: the map's meta data provided by the BeatSaver API
         :type map_JSON: dict
+        :param file_name: the name of the map's level file, parsed from the download URL when not given
+        :type file_name: str
         """
         map_dir = os.path.join(self.output_dir, map_JSON['id'])
         # if the map directory does not exist, create it
-        if not os.path.exists(map_dir): os.mkdir(map_dir)
+        os.makedirs(map_dir, exist_ok=True)
         
         download_url = map_JSON["versions"][0]['downloadURL']
-        file_name = download_url.split('/')[-1]
+        file_name = file_name or self._level_file_name(map_JSON)
 
-        self.logger.log(logging.INFO, "Downloading levels file associated with map {}".format(map_JSON['id']))
-        with requests.get(download_url, stream=True) as r:
+        self.logger.info("Downloading levels file associated with map %s", map_JSON['id'])
+        with self._session.get(download_url, stream=True) as r:
             r.raise_for_status()
 
-            # write the level file to the map directory
+            # stream the level file to the map directory in 1 MiB blocks
+            r.raw.decode_content = True
             with open(os.path.join(map_dir, file_name), 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk: f.write(chunk)
+                shutil.copyfileobj(r.raw, f, length=1 << 20)
     
-    def _write_meta_file(self, map_JSON):
+    @staticmethod
+    def _level_file_name(map_JSON):
         """
-        Writes the meta file for the map.
+        Gets the name of the map's level file, from the _filename persisted with the meta record or else parsed from the download URL.
 
         :param map_JSON: the map's meta data provided by the BeatSaver API
         :type map_JSON: dict
+        :return: the name of the level file
+        :rtype: str
         """
-        map_dir = os.path.join(self.output_dir, map_JSON['id'])
-        if not os.path.exists(map_dir): os.mkdir(map_dir)
+        if '_filename' in map_JSON:
+            return map_JSON['_filename']
 
-        self.logger.log(logging.INFO, "Writing meta file for map: {}".format(map_JSON['id']))
-        with open(os.path.join(map_dir, self._META_FILE), 'w') as f:
-            json.dump(map_JSON, f)
-        
-        return(os.path.join(map_dir, self._META_FILE))
+        return map_JSON['versions'][0]['downloadURL'].rsplit('/', 1)[-1]
+
+    def _write_meta_file(self, map_JSON, file_name=None):
+        """
+        Appends the meta data of the map to the meta log.
+
+        :param map_JSON: the map's meta data provided by the BeatSaver API
+        :type map_JSON: dict
+        :param file_name: the name of the map's level file, parsed from the download URL when not given
+        :type file_name: str
+        :return: the name of the map's level file
+        :rtype: str
+        """
+        self.logger.info("Writing meta record for map: %s", map_JSON['id'])
+        # the level file name is persisted with the record so it is available on reload
+        file_name = file_name or self._level_file_name(map_JSON)
+        # written from a copy, the response the map came from may still be held by the ETag cache
+        self._meta_log.write(_dumps({**map_JSON, '_filename': file_name}) + b"\n")
+        self._meta_log.flush()
+
+        return file_name
         
-    def _get_existing_maps(self):
+    def _load_registry(self):
         """
-        Gets the existing maps in the output directory. 
+        Loads the existing maps from the registry manifest. Falls back to scanning the output directory
+        when the manifest is missing, unreadable or older than the output directory.
 
         :return: a dictionary of the existing maps
         :rtype: dict
         """
-        existing_maps = {}
-        self.logger.log(logging.INFO, "Checking for existing maps...")
+        registry = None
+        if os.path.exists(self._registry_path):
+            try:
+                with open(self._registry_path, 'rb') as f:
+                    registry = _loads(f.read())
+
+                self._covered = registry.get('covered') or []
+            except (ValueError, AttributeError):
+                registry = None
+                self.logger.info("Registry %s is corrupted, rescanning the output directory", self._registry_path)
+
+        if registry and 'maps' in registry and os.path.getmtime(self._registry_path) >= os.path.getmtime(self.output_dir):
+            self.logger.info("Loading existing maps from %s", self._registry_path)
+            return registry['maps']
+
+        # the maps of a stale registry have already been verified and don't need to be checked again
+        existing_maps = self._get_existing_maps(registry.get('maps', {}) if registry else {})
+        self._save_registry(existing_maps)
+
+        return existing_maps
+
+    def _save_registry(self, maps=None):
+        """
+        Writes the existing maps to the registry manifest.
+
+        :param maps: the maps to write, by default the maps of the downloader
+        :type maps: dict
+        """
+        # write to a temporary file first so a crash mid-write can't corrupt the manifest
+        tmp_path = self._registry_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_dumps({'maps': self.maps if maps is None else maps, 'covered': self._covered}))
+
+        os.replace(tmp_path, self._registry_path)
+        # the rename updates the output directory's mtime, touch the manifest so it isn't considered stale
+        os.utime(self._registry_path)
+
+    def _covering_range(self, published):
+        """
+        Finds the covered range a lastPublishedAt timestamp falls in, above the range's bottom.
+
+        :param published: the lastPublishedAt timestamp
+        :type published: str
+        :return: the covered range, or None
+        :rtype: list
+        """
+        return next((covered for covered in self._covered if covered[0] < published <= covered[1]), None)
+
+    def _extend_covered(self, bottom, top):
+        """
+        Adds a range paged through without gaps to the covered ranges, merging the ranges it touches.
+        Ranges it doesn't touch are kept, so a short run never discards the known history.
+
+        :param bottom: the lastPublishedAt cursor the range was paged down to
+        :type bottom: str
+        :param top: the lastPublishedAt timestamp of the newest map the range was paged from
+        :type top: str
+        """
+        if top is None or not bottom < top:
+            return
+
+        merged = []
+        for covered in sorted(self._covered + [[bottom, top]]):
+            if merged and covered[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], covered[1])
+            else:
+                merged.append(list(covered))
+
+        self._covered = merged
+
+    def _uncover(self, published):
+        """
+        Drops the covered ranges a lastPublishedAt timestamp falls in, once a map published then is no longer downloaded.
+
+        :param published: the lastPublishedAt timestamp of the map
+        :type published: str
+        """
+        if published is None:
+            # without a timestamp the map could be anywhere in the covered history
+            self._covered = []
+            return
+
+        self._covered = [covered for covered in self._covered if not covered[0] <= published <= covered[1]]
+
+    def _migrate_meta_files(self):
+        """
+        Migrates the per-map meta files written by earlier versions into the meta log, so an output directory
+        populated by them isn't downloaded all over again.
+        """
+        records = []
         with os.scandir(self.output_dir) as levels:
-            # iterate through all the directories in the output directory
             for level in levels:
-                if level.is_dir():
-                    with os.scandir(level) as files:
-                        # iterate through all the files in the directory
-                        for file in files:
-                            # if the file is a meta file, add the map to the existing maps dictionary
-                            if file.is_file() and file.name == self._META_FILE:
-                                self.logger.log(logging.INFO, "Found prexisting map at {}".format(level.path))
-                                existing_maps[level.name] = file.path
-
-                                if len(os.listdir(os.path.dirname(file.path))) < 2:
-                                    self.logger.log(logging.INFO, "Map {} is missing its level file".format(level.name))
-                                    self._finish_downloading(file.path)
+                meta_path = os.path.join(level.path, self._LEGACY_META_FILE)
+                if level.is_dir() and os.path.isfile(meta_path):
+                    with open(meta_path, 'rb') as f:
+                        meta_JSON = _loads(f.read())
 
-        
+                    records.append(_dumps({**meta_JSON, '_filename': self._level_file_name(meta_JSON)}) + b"\n")
+
+        if not records:
+            return
+
+        self.logger.warning("Migrating %s per-map %s files into %s", len(records), self._LEGACY_META_FILE, self._META_LOG)
+        # write to a temporary file first so an interrupted migration is simply redone
+        tmp_path = self._meta_log_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.writelines(records)
+
+        os.replace(tmp_path, self._meta_log_path)
+
+    def _get_existing_maps(self, verified=None):
+        """
+        Gets the existing maps from the meta log of the output directory. Maps that are missing their level file
+        or that haven't been verified before are finished concurrently, a map that can't be finished is left out
+        so it is downloaded again when it is paged through.
+
+        :param verified: the maps whose level files have already been verified
+        :type verified: dict
+        :return: a dictionary of the existing maps and the names of their level files
+        :rtype: dict
+        """
+        verified = verified or {}
+        existing_maps = {}
+        # the maps that still need to be finished
+        pending = {}
+        self.logger.info("Checking for existing maps...")
+        if not os.path.exists(self._meta_log_path):
+            self._migrate_meta_files()
+
+        if not os.path.exists(self._meta_log_path):
+            return existing_maps
+
+        with open(self._meta_log_path, 'rb') as f:
+            # iterate through all the records of the meta log
+            for line_no, line in enumerate(f, 1):
+                try:
+                    meta_JSON = _loads(line)
+                except ValueError:
+                    # a record cut short by an interrupted run, the map will be downloaded again
+                    self.logger.info("Skipping truncated meta record on line %s", line_no)
+                    continue
+
+                # a map written more than once keeps its latest record
+                file_name = self._level_file_name(meta_JSON)
+                existing_maps[meta_JSON['id']] = file_name
+                if meta_JSON['id'] not in verified or not os.path.exists(os.path.join(self.output_dir, meta_JSON['id'], file_name)):
+                    pending[meta_JSON['id']] = meta_JSON
+                else:
+                    pending.pop(meta_JSON['id'], None)
+
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            futures = {executor.submit(self._finish_downloading, meta_JSON): map_id for map_id, meta_JSON in pending.items()}
+            for future in as_completed(futures):
+                # a single map, e.g. one removed from the CDN, must not keep the downloader from starting
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error("Unable to finish map %s, it will be downloaded again: %s", futures[future], e)
+                    del existing_maps[futures[future]]
+                    # the map's page must be paged through again rather than jumped over
+                    self._uncover(pending[futures[future]].get('lastPublishedAt'))
+
+        self.logger.info("Found %s prexisting maps", len(existing_maps))
         return existing_maps
     
 
@@ -202,16 +490,44 @@ class BSDownloader():
         :return: the JSON response
         """
         
-        self.logger.log(logging.INFO, "Requesting for JSONs from {} endpoint".format(ENDPOINT))
-        r = requests.get(ENDPOINT, params=params)
-        r.raise_for_status()
+        self.logger.info("Requesting for JSONs from %s endpoint", ENDPOINT)
+        key = "{}?{}".format(ENDPOINT, urlencode(sorted(params.items())))
+        # popped so a reinserted entry moves to the end, the cache evicts its least recently used entries
+        cached = self._etag_cache.pop(key, None)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+
+        r = self._session.get(ENDPOINT, params=params, headers=headers)
+        # the response has not changed since it was last requested
+        if r.status_code == 304 and cached:
+            self.logger.info("Response from %s endpoint not modified", ENDPOINT)
+            response = cached[1]
+            etag = cached[0]
+        else:
+            r.raise_for_status()
+            response = r.json()
+            etag = r.headers.get('ETag')
 
-        return r.json()
+        if etag:
+            self._etag_cache[key] = [etag, response]
+            while len(self._etag_cache) > self.ETAG_CACHE_SIZE:
+                del self._etag_cache[next(iter(self._etag_cache))]
+
+        return response
+
+    def close(self):
+        """
+        Closes the underlying HTTP session and its pooled connections, and the meta log.
+        """
+        self._session.close()
+        self._meta_log.close()
 
 def main(before, n_maps, output_dir):
     downloader = BSDownloader(before, n_maps, output_dir)
 
-    count = downloader.download_latest()
+    try:
+        count = downloader.download_latest()
+    finally:
+        downloader.close()
     print(f"Finished scraping maps. A total of {count} maps were downloaded.")
     
 
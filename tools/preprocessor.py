@@ -8,12 +8,31 @@ TODO: Option to squelch logging.
 
 import argparse
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 import os
+import shutil
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("NSAC-Preprocessor")
 
+def _member_path(output_dir, filename):
+    """
+    Get the path a zip member is extracted to, sanitized the same way ZipFile.extractall does: drive letters,
+    leading separators and '.'/'..' components are dropped so the member always stays inside the output directory.
+
+    :param output_dir: The path to the output directory.
+    :param filename: The name of the member in the archive.
+    :return: The path to extract the member to, or None if nothing is left of its name.
+    """
+    arcname = filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(part for part in arcname.split(os.path.sep) if part not in ('', os.path.curdir, os.path.pardir))
+
+    return os.path.join(output_dir, arcname) if arcname else None
+
 def unzip_file(file_path, output_dir):
     """
     Unzip a file.
@@ -23,30 +42,93 @@ def unzip_file(file_path, output_dir):
     return: None
     """
     with zipfile.ZipFile(file_path, 'r') as zip_ref:
-        zip_ref.extractall(output_dir)
+        try:
+            # extract member by member through 1 MiB buffers, the archives mostly hold a few large audio files
+            for info in zip_ref.infolist():
+                target = _member_path(output_dir, info.filename)
+                if target is None:
+                    continue
+
+                if info.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with zip_ref.open(info) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, length=1 << 20)
+        except BaseException:
+            # a partially extracted directory would otherwise be mistaken for a finished one on the next run
+            shutil.rmtree(output_dir, ignore_errors=True)
+            raise
+
+def _iter_zips(input_dir_path):
+    """
+    Find all the zip files in the map directories of the input directory.
+
+    :param input_dir_path: The path to the input directory.
+    :param type: str
+    :return: The paths to the zip files.
+    """
+    with os.scandir(input_dir_path) as subdirs:
+        for subdir in subdirs:
+            if not subdir.is_dir(): continue
+
+            with os.scandir(subdir.path) as files:
+                for file in files:
+                    if file.name.endswith(".zip") and file.is_file():
+                        yield file.path
+
+def _is_extracted(output_dir):
+    """
+    Check whether a zip file has already been extracted to its output directory.
+
+    :param output_dir: The path to the output directory.
+    :param type: str
+    :return: True if the output directory exists and is non-empty.
+    """
+    if not os.path.isdir(output_dir):
+        return False
+
+    with os.scandir(output_dir) as entries:
+        return next(entries, None) is not None
+
+def _unzip_job(job):
+    """
+    Unzip a single (file_path, output_dir) job in a worker process. Bad zip files and any other extraction
+    errors are logged and skipped so they don't abort the rest of the batch.
+
+    :param job: The path to the file to unzip and the path to the output directory.
+    :param type: tuple
+    return: None
+    """
+    file_path, output_dir = job
+    file = os.path.basename(file_path)
+    logger.info("Unzipping file: %s", file)
+
+    try:
+        unzip_file(file_path, output_dir)
+    except zipfile.BadZipFile as e:
+        logger.error("Bad zip file: %s", file)
+    except Exception:
+        # any other failure is contained to this file, otherwise executor.map would re-raise it and abort the batch
+        logger.exception("Unable to unzip file: %s", file_path)
 
 def unzip(input_dir_path):
     """
-    Unzip all the files in the input directory.
+    Unzip all the files in the input directory. Decompression is CPU bound, so the files are spread
+    across a pool of processes.
 
     :param input_dir_path: The path to the input directory.
     :param type: str
     :return: None
     """
-    for dir in os.listdir(input_dir_path):
-        subdir_path = os.path.join(input_dir_path, dir)
-        for file in os.listdir(subdir_path):
-            if file.endswith(".zip"):
-                logger.log(logging.Info, "Unzipping file: {}".format(file))
-                full_path = os.path.join(subdir_path, file)
-                
-                try:
-                    unzip_file(full_path, full_path[:-4])
-                except zipfile.BadZipFile as e: 
-                    if(logger):
-                        logger.error("Bad zip file: {}".format(file))
-                    else:
-                        print(f"Unable to unzip file {full_path}")
+    # zip files that were extracted on a previous run are skipped
+    jobs = [(full_path, full_path[:-4]) for full_path in _iter_zips(input_dir_path) if not _is_extracted(full_path[:-4])]
+    workers = os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # batch the many small archives to cut down on inter-process overhead
+        list(executor.map(_unzip_job, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
                     
 
 def main(args):
@@ -62,8 +144,7 @@ if __name__ == '__main__':
    
     args = parser.parse_args()
 
-    if not os.path.exists(args.output_dir):
-        logger.log(logging.INFO, f"Creating output directory {args.output_dir}")
-        os.makedirs(args.output_dir)
+    logger.info("Using output directory %s", args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
 
     main(args)
\ No newline at end of file